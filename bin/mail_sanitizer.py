@@ -6,27 +6,96 @@ import glob
 import os
 
 from kittengroomer_email import KittenGroomerMail
+from kittengroomer_email.helpers import check_stats
+from kittengroomer_email.pipeline import BatchPipeline
+from kittengroomer_email.admission import AdmissionController
+from kittengroomer_email.cache import MessageCache
 
 
-def process_dir(path_in, path_out):
-    for f in glob.glob(os.path.join(path_in, '*')):
-        outfile = f.replace(path_in, path_out)
-        try:
-            t = KittenGroomerMail(open(f, 'rb').read())
-        except:
-            print('Failed to process', f)
-            continue
-        parsed_email = t.process_mail()
-        if not os.path.exists(os.path.dirname(outfile)):
-            os.makedirs(os.path.dirname(outfile))
-        with open(outfile, 'wb') as out:
-            out.write(parsed_email.as_bytes())
+def process_dir(path_in, path_out, full_report=False, read_ahead=8, write_behind=8, fsync_batch=0,
+                strict_ole=False, workers=1, admission=None, cache=None):
+    def groom(raw_email):
+        t = KittenGroomerMail(raw_email, full_report=full_report, strict_ole=strict_ole, cache=cache)
+        return t.process_mail().as_bytes()
+
+    jobs = ((f, f.replace(path_in, path_out)) for f in glob.glob(os.path.join(path_in, '*')))
+    pipeline = BatchPipeline(groom, read_ahead, write_behind, fsync_batch, workers, admission)
+    return pipeline.run(jobs)
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
+def print_check_stats():
+    for c in check_stats.report():
+        print('{name}: cost {cost}, {hits}/{runs} hits ({hit_rate:.2%}), {avg_time:.6f}s avg'.format(**c))
+
+
+def print_pipeline_stats(stats):
+    for stage in ('reader', 'large', 'groomer', 'writer'):
+        if stage in stats:
+            print('{}: {items} mails, {busy:.3f}s busy, {wait:.3f}s waiting'.format(stage, **stats[stage]))
+    if 'cache' in stats:
+        print('cache: {hits} hits, {misses} misses ({hit_rate:.2%}), {evictions} evicted, {expired} expired, '
+              '{entries} entries, {size} bytes'.format(**stats['cache']))
+    if 'admission' in stats:
+        admission = stats['admission']
+        print('admission: {admitted} mails ({large} large), {wait:.3f}s waiting, '
+              'peak {peak_in_flight} bytes in flight'.format(**admission))
+        if 'ratio_mean' in admission:
+            print('memory: {samples} mails sampled, peak {peak_max} bytes, '
+                  'observed/estimated {ratio_mean:.2f} avg, {ratio_max:.2f} max'.format(**admission))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='KittenGroomer email processor', description="Sanitize emails")
     parser.add_argument('-s', '--source', required=True, type=str, help='Source directory')
     parser.add_argument('-d', '--destination', required=True, type=str, help='Destination directory')
+    parser.add_argument('--full-report', action='store_true',
+                        help='Run all the checks, even on attachments already considered as dangerous')
+    parser.add_argument('--check-stats', action='store_true',
+                        help='Print the hit rate and the cost of each check')
+    parser.add_argument('--strict-ole', action='store_true',
+                        help='Always parse the Office documents with olefile, skip the fast pre-scan')
+    parser.add_argument('--read-ahead', type=positive_int, default=8, help='Number of mails read in advance')
+    parser.add_argument('--write-behind', type=positive_int, default=8, help='Number of groomed mails waiting to be written')
+    parser.add_argument('--fsync-batch', type=int, default=0,
+                        help='fsync the written mails every N mails (default: never)')
+    parser.add_argument('--workers', type=positive_int, default=1, help='Number of grooming threads')
+    parser.add_argument('--memory-budget', type=int, default=0,
+                        help='Maximum estimated memory (MB) used by the mails in flight (default: no limit)')
+    parser.add_argument('--large-threshold', type=int, default=None,
+                        help='Mails estimated above this (MB) are groomed one at a time '
+                             '(default: a quarter of the budget)')
+    parser.add_argument('--memory-sample', type=int, default=0,
+                        help='Measure the peak memory of one mail every N (default: never)')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Size (MB) of the cache of sanitized mails, for redeliveries (default: no cache)')
+    parser.add_argument('--cache-ttl', type=int, default=3600, help='Lifetime (s) of the cached mails')
+    parser.add_argument('--pipeline-stats', action='store_true',
+                        help='Print the time spent working and waiting in each stage')
     args = parser.parse_args()
 
-    process_dir(args.source, args.destination)
+    admission = None
+    if args.memory_budget:
+        large_threshold = None
+        if args.large_threshold is not None:
+            large_threshold = args.large_threshold * 2 ** 20
+        admission = AdmissionController(args.memory_budget * 2 ** 20, large_threshold,
+                                        sample_every=args.memory_sample)
+    cache = None
+    if args.cache_size:
+        cache = MessageCache(args.cache_size * 2 ** 20, args.cache_ttl)
+    stats = process_dir(args.source, args.destination, args.full_report,
+                        args.read_ahead, args.write_behind, args.fsync_batch, args.strict_ole,
+                        args.workers, admission, cache)
+    if cache is not None:
+        stats['cache'] = cache.report()
+    if args.check_stats:
+        print_check_stats()
+    if args.pipeline_stats:
+        print_pipeline_stats(stats)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Working set of a mail, relative to its size: the raw mail, the parsed tree,
+# the decoded attachments and the reassembled (base64 encoded) mail
+base_factor = 4
+# Extra allowance for the archives, decompressed in memory
+archive_factor = 4
+archive_types = (b'zip', b'rar', b'bzip2', b'lzip', b'lzma', b'lzop', b'xz', b'compress', b'gzip', b'tar')
+content_type_re = re.compile(br'^content-type:\s*([\w.+-]+/[\w.+-]+)', re.IGNORECASE | re.MULTILINE)
+# Beginning of the mail read to find the Content-Type headers, before admitting it
+peek_size = 2 ** 16
+
+
+def estimate_footprint(size, head=b''):
+    '''
+        Estimate the memory needed to groom a mail from its size and the
+        Content-Type headers of its parts found in head (its beginning), without parsing it.
+    '''
+    estimate = base_factor * size
+    for content_type in content_type_re.findall(head):
+        content_type = content_type.lower()
+        if any(a in content_type for a in archive_types):
+            estimate += archive_factor * size
+            break
+    return estimate
+
+
+def estimate_file(f):
+    '''
+        Estimate the memory needed to groom the mail in the open file f, without
+        reading it whole. f is rewound: the mail can then be read from the same handle.
+    '''
+    size = os.fstat(f.fileno()).st_size
+    head = f.read(peek_size)
+    f.seek(0)
+    return estimate_footprint(size, head)
+
+
+class AdmissionTicket(object):
+
+    def __init__(self, estimate, charge, large, sample):
+        '''
+            Budget held by a mail, from before it is read until the end of its grooming
+        '''
+        self.estimate = estimate
+        self.charge = charge
+        self.large = large
+        self.sample = sample
+
+
+class AdmissionController(object):
+
+    def __init__(self, budget, large_threshold=None, large_concurrency=1, sample_every=0):
+        '''
+            Admit the mails against a global budget of bytes in flight, shared by
+            all the workers. Mails estimated above large_threshold (default: a quarter of
+            the budget) go through a lane allowing large_concurrency of them at once.
+            One mail every sample_every (0: never) is groomed alone with tracemalloc on,
+            to compare its observed peak memory with the estimate.
+            A mail gets a ticket (ticket) when it is opened, is admitted (admit) before
+            it is read and releases the budget at the end of its grooming (grooming).
+        '''
+        self.budget = budget
+        if large_threshold is None:
+            large_threshold = budget // 4
+        self.large_threshold = large_threshold
+        self.large_lane = threading.BoundedSemaphore(large_concurrency)
+        self.sample_every = sample_every
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        # Large mails waiting for the budget, admitted from another thread than the
+        # small ones: hold back the small ones so the large ones are not starved
+        self.reserved = 0
+        self.stats = {'admitted': 0, 'large': 0, 'wait': 0., 'peak_in_flight': 0}
+        # (estimate, observed peak) of the sampled mails
+        self.samples = []
+        self.nb_tickets = 0
+
+    def _acquire(self, charge, exclusive):
+        start = time.perf_counter()
+        with self.cond:
+            if exclusive:
+                self.reserved += 1
+            try:
+                while self.in_flight + charge > self.budget or (self.reserved and not exclusive):
+                    self.cond.wait()
+            finally:
+                if exclusive:
+                    self.reserved -= 1
+            self.in_flight += charge
+            self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.in_flight)
+            self.stats['wait'] += time.perf_counter() - start
+
+    def _release(self, charge):
+        with self.cond:
+            self.in_flight -= charge
+            self.cond.notify_all()
+
+    def ticket(self, f):
+        '''
+            Ticket of the mail in the open file f, not admitted yet.
+            The large mails have to be admitted by another thread than the small ones
+            (see BatchPipeline), not to block them.
+        '''
+        estimate = estimate_file(f)
+        with self.cond:
+            self.nb_tickets += 1
+            sample = bool(self.sample_every) and self.nb_tickets % self.sample_every == 0
+        # A mail bigger than the budget is admitted alone. A sampled mail also runs
+        # alone, nothing else is read or groomed while it is traced: the peak is its own.
+        return AdmissionTicket(estimate, self.budget if sample else min(estimate, self.budget),
+                               estimate > self.large_threshold, sample)
+
+    def admit(self, ticket):
+        '''
+            Blocks until the mail fits in the budget, call it before reading the mail.
+        '''
+        if ticket.large:
+            self.large_lane.acquire()
+        try:
+            self._acquire(ticket.charge, ticket.large)
+        except:
+            if ticket.large:
+                self.large_lane.release()
+            raise
+        with self.cond:
+            self.stats['admitted'] += 1
+            if ticket.large:
+                self.stats['large'] += 1
+
+    def release(self, ticket):
+        self._release(ticket.charge)
+        if ticket.large:
+            self.large_lane.release()
+
+    @contextmanager
+    def grooming(self, ticket, raw_email):
+        '''
+            The grooming of the mail is done in the with block, the budget is released after it.
+        '''
+        try:
+            # Not if something else (i.e. python -X tracemalloc) is already tracing
+            if ticket.sample and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                try:
+                    yield
+                    current, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                with self.cond:
+                    self.samples.append((ticket.estimate, peak + len(raw_email)))
+            else:
+                yield
+        finally:
+            self.release(ticket)
+
+    def report(self):
+        with self.cond:
+            to_return = dict(self.stats)
+            to_return['samples'] = len(self.samples)
+            if self.samples:
+                ratios = [peak / estimate for estimate, peak in self.samples if estimate]
+                to_return['peak_max'] = max(peak for estimate, peak in self.samples)
+                if ratios:
+                    to_return['ratio_mean'] = sum(ratios) / len(ratios)
+                    to_return['ratio_max'] = max(ratios)
+        return to_return
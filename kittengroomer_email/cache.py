@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+
+
+class MessageCache(object):
+
+    def __init__(self, max_size=256 * 2 ** 20, ttl=3600):
+        '''
+            LRU cache of the sanitized attachments of the mails, shared by the groomers.
+            max_size bounds the sum of the sizes of the entries (bytes),
+            entries older than ttl (seconds) are discarded.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key => (insertion time, size, value), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def _remove(self, key):
+        inserted, size, value = self.entries.pop(key)
+        self.size -= size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self._remove(key)
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def put(self, key, value, size):
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic(), size, value)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def report(self):
+        with self.lock:
+            to_return = dict(self.stats)
+            to_return['entries'] = len(self.entries)
+            to_return['size'] = self.size
+        lookups = to_return['hits'] + to_return['misses']
+        to_return['hit_rate'] = to_return['hits'] / lookups if lookups else 0.
+        return to_return
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import time
+import threading
 import magic
 from twiggy import outputs, filters, log, formats, emitters, levels
 
@@ -24,10 +26,102 @@ class ImplementationRequired(KittenGroomerError):
     pass
 
 
+class MimeTreeError(KittenGroomerError):
+    '''
+        The MIME tree of the mail exceeds the depth or part-count limits
+    '''
+    pass
+
+
+def walk_mime(message, max_depth=10, max_parts=500):
+    '''
+        Iterative depth-first walk of the MIME tree, yields (path, part) for each leaf.
+        The path is the tuple of the indexes of the part in the payloads of its ancestors.
+        The payload lists are iterated in place, the subtrees are never copied.
+    '''
+    if not message.is_multipart():
+        yield (), message
+        return
+    nb_parts = 0
+    stack = [((), enumerate(message.get_payload()))]
+    while stack:
+        path, children = stack[-1]
+        try:
+            index, part = next(children)
+        except StopIteration:
+            stack.pop()
+            continue
+        nb_parts += 1
+        if nb_parts > max_parts:
+            raise MimeTreeError('More than {} MIME parts'.format(max_parts))
+        cur_path = path + (index,)
+        if part.is_multipart():
+            if len(cur_path) >= max_depth:
+                raise MimeTreeError('MIME tree deeper than {}'.format(max_depth))
+            stack.append((cur_path, enumerate(part.get_payload())))
+        else:
+            yield cur_path, part
+
+
+def get_mime_part(message, path):
+    '''
+        Return the part of the MIME tree at path (see walk_mime)
+    '''
+    for index in path:
+        message = message.get_payload()[index]
+    return message
+
+
+class CheckStats(object):
+
+    def __init__(self):
+        '''
+            Collect the cost and the hit rate of every check, to tune their order.
+        '''
+        self.lock = threading.Lock()
+        self.checks = {}
+
+    def record(self, name, cost, hit, elapsed):
+        with self.lock:
+            entry = self.checks.setdefault(name, {'cost': cost, 'runs': 0, 'hits': 0, 'time': 0.})
+            entry['runs'] += 1
+            entry['time'] += elapsed
+            if hit:
+                entry['hits'] += 1
+
+    def report(self):
+        '''
+            Hit rate and average run time of each check, most rewarding first
+        '''
+        to_return = []
+        with self.lock:
+            for name, entry in self.checks.items():
+                to_return.append({'name': name, 'cost': entry['cost'], 'runs': entry['runs'],
+                                  'hits': entry['hits'],
+                                  'hit_rate': entry['hits'] / entry['runs'],
+                                  'avg_time': entry['time'] / entry['runs']})
+        return sorted(to_return, key=lambda c: c['hit_rate'] / max(c['avg_time'], 1e-9), reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.checks = {}
+
+
+# Shared by all the groomers of the process, feeds the tuning of the cost hints
+check_stats = CheckStats()
+
+
 class FileBaseMem(object):
 
-    def __init__(self, file_obj, orig_filename=None):
-        self.file_obj = BytesIO(file_obj)
+    def __init__(self, file_obj, orig_filename=None, mimetype=None):
+        '''
+            mimetype skips libmagic, for files whose content is not there (i.e. not extracted)
+        '''
+        if hasattr(file_obj, 'read'):
+            # Already a file object (i.e. spilled to a temporary file), at position 0
+            self.file_obj = file_obj
+        else:
+            self.file_obj = BytesIO(file_obj)
         self.orig_filename = orig_filename
         if self.orig_filename:
             self.final_filename = self.orig_filename
@@ -40,12 +134,15 @@ class FileBaseMem(object):
         else:
             self.extension = None
 
-        try:
-            mt = magic.from_buffer(self.file_obj.getvalue(), mime=True)
-        except UnicodeEncodeError as e:
-            # FIXME: The encoding of the file is broken (possibly UTF-16)
-            mt = ''
-            self.log_details.update({'UnicodeError': e})
+        if mimetype is not None:
+            mt = mimetype
+        else:
+            try:
+                mt = magic.from_buffer(self.get_head(), mime=True)
+            except UnicodeEncodeError as e:
+                # FIXME: The encoding of the file is broken (possibly UTF-16)
+                mt = ''
+                self.log_details.update({'UnicodeError': e})
         try:
             self.mimetype = mt.decode("utf-8")
         except:
@@ -57,6 +154,28 @@ class FileBaseMem(object):
             self.main_type = ''
             self.sub_type = ''
 
+    def get_data(self):
+        '''
+            Full content of the file
+        '''
+        if isinstance(self.file_obj, BytesIO):
+            return self.file_obj.getvalue()
+        self.file_obj.seek(0)
+        data = self.file_obj.read()
+        self.file_obj.seek(0)
+        return data
+
+    def get_head(self, size=2 ** 20):
+        '''
+            Beginning of the file, enough for libmagic
+        '''
+        if isinstance(self.file_obj, BytesIO):
+            return self.file_obj.getvalue()
+        self.file_obj.seek(0)
+        head = self.file_obj.read(size)
+        self.file_obj.seek(0)
+        return head
+
     def has_mimetype(self):
         if not self.main_type or not self.sub_type:
             self.log_details.update({'broken_mime': True})
@@ -74,6 +193,19 @@ class FileBaseMem(object):
             return True
         return False
 
+    def run_checks(self, checks, full_report=False):
+        '''
+            Run a list of (cost, name, check) tuples, cheapest first.
+            A check returns True when it found something.
+            Stops as soon as the file is dangerous, unless full_report is set.
+        '''
+        for cost, name, check in sorted(checks, key=lambda c: c[0]):
+            if self.is_dangerous() and not full_report:
+                return
+            start = time.perf_counter()
+            hit = check()
+            check_stats.record(name, cost, hit, time.perf_counter() - start)
+
     def add_log_details(self, key, value):
         '''
             Add an entry in the log dictionary
@@ -92,6 +224,15 @@ class FileBaseMem(object):
         self.log_details['dangerous'] = True
         self.final_filename = 'DANGEROUS_{}_DANGEROUS'.format(self.final_filename)
 
+    def make_removed(self):
+        '''
+            The content of this file has not been kept, only its name is left.
+            Appending .removed: the empty file can not be mistaken for the original one.
+        '''
+        self.log_details['dangerous'] = True
+        self.log_details['removed'] = True
+        self.final_filename = '{}.removed'.format(self.final_filename)
+
     def make_unknown(self):
         '''
             This file has an unknown type and it was not possible to take
@@ -124,14 +265,15 @@ class FileBaseMem(object):
 
 class KittenGroomerMailBase(object):
 
-    def __init__(self, raw_email, debug=False):
+    def __init__(self, raw_email, debug=False, max_depth=10, max_parts=500):
         '''
             Setup the base options of the copy/convert setup
         '''
         self.raw_email = raw_email
         self.log_processing = StringIO()
         self.log_content = StringIO()
-        self.tree(self.raw_email)
+        self.max_depth = max_depth
+        self.max_parts = max_parts
 
         twiggy_out = outputs.StreamOutput(formats.shell_format, stream=self.log_processing)
         emitters['*'] = filters.Emitter(levels.DEBUG, True, twiggy_out)
@@ -150,9 +292,12 @@ class KittenGroomerMailBase(object):
             self.log_debug_err = os.devnull
             self.log_debug_out = os.devnull
 
-    def tree(self, raw_email):
-        # TODO: Tree-like function for the email
-        return
+    def tree(self, parsed_email):
+        '''
+            Yields (path, part) for each leaf of the MIME tree of the email.
+            Raises MimeTreeError if the tree is too deep or has too many parts.
+        '''
+        return walk_mime(parsed_email, self.max_depth, self.max_parts)
 
     def process_mail(self, raw_email=None):
         '''
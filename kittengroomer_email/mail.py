@@ -2,14 +2,19 @@
 # -*- coding: utf-8 -*-
 
 from email.parser import BytesParser
+from email.message import Message
 from email.utils import make_msgid
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
 from email import encoders
 from email.header import decode_header
 
 from .helpers import FileBaseMem
 from .helpers import KittenGroomerMailBase
+from .helpers import MimeTreeError
+from .helpers import get_mime_part
+from .olescan import has_macros, OleScanError
 
 import mimetypes
 import olefile
@@ -20,6 +25,8 @@ import lzma
 import bz2
 import gzip
 import os
+import tempfile
+import hashlib
 from pdfid.pdfid import PDFiD, cPDFiD
 from io import BytesIO
 
@@ -35,6 +42,9 @@ mimes_compressed = ['zip', 'rar', 'bzip2', 'lzip', 'lzma', 'lzop',
                     'xz', 'compress', 'gzip', 'tar']
 mimes_data = ['octet-stream']
 mimes_force_text = ['pgp-signature']
+# Multiparts whose parts are all shown as (or as alternatives of) the body:
+# the logs and Sanitized.txt must not be added in them
+mimes_body = ['multipart/related', 'multipart/alternative']
 
 # Prepare image/<subtype>
 mimes_exif = ['image/jpeg', 'image/tiff']
@@ -80,32 +90,62 @@ mal_ext = (
     ".wax", ".wm", ".wma", ".wmd", ".wmv", ".wmx", ".wmz", ".wvx",
 )
 
+# Archive members
+# Bigger members (declared or actual size) are not extracted
+max_member_size = 100 * 2 ** 20
+# Members compressed more than that are not extracted (zip bombs)...
+max_compression_ratio = 100
+# ... if they are big enough
+min_ratio_size = 2 ** 20
+# Bigger members are decompressed to a temporary file
+spill_size = 10 * 2 ** 20
+chunk_size = 2 ** 16
+
 
 class File(FileBaseMem):
 
-    def __init__(self, file_obj, orig_filename):
+    def __init__(self, file_obj, orig_filename, full_report=False):
         ''' Init file object, set the mimetype '''
         super(File, self).__init__(file_obj, orig_filename)
         self.is_recursive = False
+        self.log_details.update({'maintype': self.main_type,
+                                 'subtype': self.sub_type,
+                                 'extension': self.extension})
+        # (cost hint, name, check), cheapest first. libmagic already ran in FileBaseMem:
+        # these are lookups, except guess_all_extensions which scans the whole types map
+        checks = [
+            (0, 'no_mimetype', self._check_mimetype),
+            (0, 'no_extension', self._check_extension),
+            (1, 'malicious_extension', self._check_malicious_extension),
+            (1, 'expected_mimetype', self._check_expected_mimetype),
+            (10, 'expected_extensions', self._check_expected_extensions),
+        ]
+        self.run_checks(checks, full_report)
+
+    def _check_mimetype(self):
         if not self.has_mimetype():
             # No mimetype, should not happen.
             self.make_dangerous()
+            return True
+        return False
 
+    def _check_extension(self):
         if not self.has_extension():
             self.make_dangerous()
+            return True
+        return False
 
+    def _check_malicious_extension(self):
         if self.extension in mal_ext:
             self.log_details.update({'malicious_extension': self.extension})
             self.make_dangerous()
+            return True
+        return False
 
-        if self.is_dangerous():
-            return
-
-        self.log_details.update({'maintype': self.main_type,
-                                 'subtype': self.sub_type,
-                                 'extension': self.extension})
-
-        # Check correlation known extension => actual mime type
+    def _check_expected_mimetype(self):
+        ''' Check correlation known extension => actual mime type '''
+        if not self.extension:
+            return False
         if propertype.get(self.extension) is not None:
             expected_mimetype = propertype.get(self.extension)
         else:
@@ -118,8 +158,13 @@ class File(FileBaseMem):
         if is_known_extension and expected_mimetype != self.mimetype:
             self.log_details.update({'expected_mimetype': expected_mimetype})
             self.make_dangerous()
+            return True
+        return False
 
-        # check correlation actual mime type => known extensions
+    def _check_expected_extensions(self):
+        ''' Check correlation actual mime type => known extensions '''
+        if not self.extension:
+            return False
         if aliases.get(self.mimetype) is not None:
             mimetype = aliases.get(self.mimetype)
         else:
@@ -129,22 +174,31 @@ class File(FileBaseMem):
         if expected_extensions:
             extra_ext = [aliases_ext.get(ext) for ext in expected_extensions if aliases_ext.get(ext, None)]
             expected_extensions.update(extra_ext)
-            if len(self.extension) > 0 and self.extension not in expected_extensions:
+            if self.extension not in expected_extensions:
                 self.log_details.update({'expected_extensions': list(expected_extensions)})
                 # self.make_dangerous()
+                return True
         else:
             # there are no known extensions associated to this mimetype.
             pass
+        return False
 
 
 class KittenGroomerMail(KittenGroomerMailBase):
 
-    def __init__(self, raw_email, max_recursive=2, debug=False):
-        super(KittenGroomerMail, self).__init__(raw_email, debug)
+    def __init__(self, raw_email, max_recursive=2, debug=False, full_report=False,
+                 max_depth=10, max_parts=500, strict_ole=False, cache=None):
+        super(KittenGroomerMail, self).__init__(raw_email, debug, max_depth, max_parts)
 
         self.recursive = 0
         self.is_archive = False
         self.max_recursive = max_recursive
+        # Run all the checks even when the attachment is already dangerous (forensics)
+        self.full_report = full_report
+        # Always parse the Office documents with olefile, not only the malformed ones
+        self.strict_ole = strict_ole
+        # Optional MessageCache, shared between the groomers
+        self.cache = cache
 
         subtypes_apps = [
             (mimes_office, self._winoffice),
@@ -218,8 +272,8 @@ class KittenGroomerMail(KittenGroomerMailBase):
         self.cur_attachment.log_string += 'Message file'
         self.recursive += 1
         fn = self.cur_attachment.orig_filename
-        sub_message = self.process_mail(self.cur_attachment.file_obj.getvalue())
-        self.cur_attachment = File(sub_message.as_bytes(), fn)
+        sub_message = self.process_mail(self.cur_attachment.get_data())
+        self.cur_attachment = File(sub_message.as_bytes(), fn, self.full_report)
         self.recursive -= 1
 
     # ##### Converted ######
@@ -256,12 +310,29 @@ class KittenGroomerMail(KittenGroomerMailBase):
     def _winoffice(self):
         # FIXME: oletools isn't compatible with python3, using olefile only
         self.cur_attachment.add_log_details('processing_type', 'WinOffice')
+        if not self.strict_ole:
+            # Fast path: only read the directory of the document
+            try:
+                if isinstance(self.cur_attachment.file_obj, BytesIO):
+                    with self.cur_attachment.file_obj.getbuffer() as buf:
+                        macros = has_macros(buf)
+                else:
+                    macros = has_macros(self.cur_attachment.get_data())
+            except OleScanError as e:
+                # Let olefile decide
+                self.cur_attachment.add_log_details('ole_prescan', e.message)
+            else:
+                if macros:
+                    self.cur_attachment.add_log_details('macro', True)
+                    self.cur_attachment.make_dangerous()
+                return
         # Try as if it is a valid document
         try:
             ole = olefile.OleFileIO(self.cur_attachment.file_obj, raise_defects=olefile.DEFECT_INCORRECT)
         except:
             self.cur_attachment.add_log_details('not_parsable', True)
             self.cur_attachment.make_dangerous()
+            return
         if ole.parsing_issues:
             self.cur_attachment.add_log_details('parsing_issues', True)
             self.cur_attachment.make_dangerous()
@@ -282,19 +353,28 @@ class KittenGroomerMail(KittenGroomerMailBase):
             return
         # There are probably other potentially malicious features:
         # fonts, custom props, custom XML
+        checks = [
+            (1, 'ooxml_macro', lambda: self._ooxml_macro(doc)),
+            (5, 'ooxml_activex', lambda: self._ooxml_feature(doc.features.embedded_controls, 'activex')),
+            # Exploited by CVE-2014-4114 (OLE)
+            (5, 'ooxml_embedded_obj', lambda: self._ooxml_feature(doc.features.embedded_objects, 'embedded_obj')),
+            (5, 'ooxml_embedded_pack', lambda: self._ooxml_feature(doc.features.embedded_packages, 'embedded_pack')),
+        ]
+        self.cur_attachment.run_checks(checks, self.full_report)
+
+    def _ooxml_macro(self, doc):
         if doc.is_macro_enabled or len(doc.features.macros) > 0:
             self.cur_attachment.add_log_details('macro', True)
             self.cur_attachment.make_dangerous()
-        if len(doc.features.embedded_controls) > 0:
-            self.cur_attachment.add_log_details('activex', True)
-            self.cur_attachment.make_dangerous()
-        if len(doc.features.embedded_objects) > 0:
-            # Exploited by CVE-2014-4114 (OLE)
-            self.cur_attachment.add_log_details('embedded_obj', True)
-            self.cur_attachment.make_dangerous()
-        if len(doc.features.embedded_packages) > 0:
-            self.cur_attachment.add_log_details('embedded_pack', True)
+            return True
+        return False
+
+    def _ooxml_feature(self, feature, log_key):
+        if len(feature) > 0:
+            self.cur_attachment.add_log_details(log_key, True)
             self.cur_attachment.make_dangerous()
+            return True
+        return False
 
     def _libreoffice(self):
         self.cur_attachment.add_log_details('processing_type', 'libreoffice')
@@ -315,90 +395,138 @@ class KittenGroomerMail(KittenGroomerMailBase):
         '''Way to process PDF file'''
         self.cur_attachment.add_log_details('processing_type', 'pdf')
         # Required to avoid having the file closed by PDFiD
-        tmp_obj = BytesIO(self.cur_attachment.file_obj.getvalue())
+        tmp_obj = BytesIO(self.cur_attachment.get_data())
         xmlDoc = PDFiD(tmp_obj)
         oPDFiD = cPDFiD(xmlDoc, True)
         # TODO: other keywords?
-        if oPDFiD.encrypt.count > 0:
-            self.cur_attachment.add_log_details('encrypted', True)
-            self.cur_attachment.make_dangerous()
-        if oPDFiD.js.count > 0 or oPDFiD.javascript.count > 0:
-            self.cur_attachment.add_log_details('javascript', True)
-            self.cur_attachment.make_dangerous()
-        if oPDFiD.aa.count > 0 or oPDFiD.openaction.count > 0:
-            self.cur_attachment.add_log_details('openaction', True)
-            self.cur_attachment.make_dangerous()
-        if oPDFiD.richmedia.count > 0:
-            self.cur_attachment.add_log_details('flash', True)
-            self.cur_attachment.make_dangerous()
-        if oPDFiD.launch.count > 0:
-            self.cur_attachment.add_log_details('launch', True)
+        checks = [
+            (1, 'pdf_javascript', lambda: self._pdf_keyword('javascript', oPDFiD.js, oPDFiD.javascript)),
+            (1, 'pdf_openaction', lambda: self._pdf_keyword('openaction', oPDFiD.aa, oPDFiD.openaction)),
+            (1, 'pdf_launch', lambda: self._pdf_keyword('launch', oPDFiD.launch)),
+            (1, 'pdf_encrypted', lambda: self._pdf_keyword('encrypted', oPDFiD.encrypt)),
+            (1, 'pdf_flash', lambda: self._pdf_keyword('flash', oPDFiD.richmedia)),
+        ]
+        self.cur_attachment.run_checks(checks, self.full_report)
+
+    def _pdf_keyword(self, log_key, *keywords):
+        if any(k.count > 0 for k in keywords):
+            self.cur_attachment.add_log_details(log_key, True)
             self.cur_attachment.make_dangerous()
+            return True
+        return False
 
-    def _zip(self):
-        '''Zip processor'''
-        archive = zipfile.ZipFile(self.cur_attachment.file_obj)
+    def _member_prefilter(self, name, size, compressed_size=None):
+        '''
+            Decide from the metadata of an archive member if it has to be decompressed.
+            Returns the reason not to extract it, None if the content has to be inspected.
+        '''
+        if size > max_member_size:
+            return 'too_big'
+        if compressed_size and size > min_ratio_size and size / compressed_size > max_compression_ratio:
+            return 'compression_ratio'
+        if self.full_report:
+            return None
+        # Dangerous whatever their content. The members without extension are
+        # extracted: they are delivered, renamed, with their content
+        if os.path.splitext(name)[1].lower() in mal_ext:
+            return 'malicious_extension'
+        return None
+
+    def _spool(self, member):
+        '''
+            Decompress a member in chunks, in memory or in a temporary file if it is big.
+            Returns None if the member is bigger than max_member_size.
+        '''
+        buf = BytesIO()
+        size = 0
+        with member:
+            for chunk in iter(lambda: member.read(chunk_size), b''):
+                size += len(chunk)
+                if size > max_member_size:
+                    buf.close()
+                    return None
+                if size > spill_size and isinstance(buf, BytesIO):
+                    spilled = tempfile.TemporaryFile()
+                    spilled.write(buf.getbuffer())
+                    buf = spilled
+                buf.write(chunk)
+        buf.seek(0)
+        return buf
+
+    def _archive_members(self, members):
+        '''
+            members yields (name, declared size, compressed size, opener) for each member.
+            Yields a File for each member, only the ones needing a content inspection are
+            decompressed (opener is called), in the order of the archive. The members not
+            extracted are empty application/octet-stream placeholders, marked as removed.
+        '''
+        for name, size, compressed_size, opener in members:
+            if opener is None:
+                reason = 'not_a_regular_file'
+            else:
+                reason = self._member_prefilter(name, size, compressed_size)
+            if reason is None:
+                content = self._spool(opener())
+                if content is not None:
+                    yield File(content, name, self.full_report)
+                    continue
+                reason = 'too_big'
+            # Nothing for libmagic to type, nor for the checks and handlers to look at
+            cur_file = FileBaseMem(b'', name, mimetype='application/octet-stream')
+            cur_file.add_log_details('not_extracted', reason)
+            cur_file.make_removed()
+            yield cur_file
+
+    def _process_members(self, members):
+        archive_file = self.cur_attachment
         loc_attach = []
-        for subfile in archive.namelist():
-            try:
-                cur_file = File(archive.open(subfile).read(), subfile)
+        try:
+            for cur_file in self._archive_members(members):
+                if cur_file.log_details.get('removed'):
+                    loc_attach.append(cur_file)
+                    continue
                 self.process_payload(cur_file)
                 loc_attach.append(self.cur_attachment)
-            except Exception:
-                self.cur_attachment.make_dangerous()
-                return [self.cur_attachment]
+        except Exception:
+            archive_file.make_dangerous()
+            return [archive_file]
         return loc_attach
 
+    def _zip(self):
+        '''Zip processor'''
+        self.cur_attachment.file_obj.seek(0)
+        archive = zipfile.ZipFile(self.cur_attachment.file_obj)
+        members = ((info.filename, info.file_size, info.compress_size, lambda info=info: archive.open(info))
+                   for info in archive.infolist() if not info.filename.endswith('/'))
+        return self._process_members(members)
+
+    def _compressed(self, open_fct):
+        '''Single compressed file processor'''
+        self.cur_attachment.file_obj.seek(0)
+        new_fn, ext = os.path.splitext(self.cur_attachment.orig_filename)
+        member = [(new_fn, 0, None, lambda: open_fct(self.cur_attachment.file_obj))]
+        attachments = self._process_members(member)
+        return attachments[0]
+
     def _lzma(self):
         '''LZMA processor'''
-        try:
-            archive = lzma.decompress(self.cur_attachment.file_obj.read())
-            new_fn, ext = os.path.splitext(self.cur_attachment.orig_filename)
-            cur_file = File(archive, new_fn)
-            self.process_payload(cur_file)
-        except:
-            self.cur_attachment.make_dangerous()
-        return self.cur_attachment
+        return self._compressed(lzma.open)
 
     def _gzip(self):
         '''GZip processor'''
-        try:
-            archive = gzip.decompress(self.cur_attachment.file_obj.read())
-            new_fn, ext = os.path.splitext(self.cur_attachment.orig_filename)
-            cur_file = File(archive, new_fn)
-            self.process_payload(cur_file)
-        except:
-            self.cur_attachment.make_dangerous()
-        return self.cur_attachment
+        return self._compressed(lambda f: gzip.GzipFile(fileobj=f))
 
     def _bzip(self):
         '''BZip2 processor'''
-        try:
-            archive = bz2.decompress(self.cur_attachment.file_obj.read())
-            new_fn, ext = os.path.splitext(self.cur_attachment.orig_filename)
-            cur_file = File(archive, new_fn)
-            self.process_payload(cur_file)
-        except:
-            self.cur_attachment.make_dangerous()
-        return self.cur_attachment
+        return self._compressed(bz2.open)
 
     def _tar(self):
-        '''Tar processor'''
-        archive = tarfile.open(mode='r', fileobj=self.cur_attachment.file_obj)
-        loc_attach = []
-        for subfile in archive.getmembers():
-            f = archive.extractfile(subfile)
-            if f is None:
-                # Directory
-                continue
-            try:
-                cur_file = File(f.read(), subfile.name)
-                self.process_payload(cur_file)
-                loc_attach.append(self.cur_attachment)
-            except Exception:
-                self.cur_attachment.make_dangerous()
-                return self.cur_attachment
-        return loc_attach
+        '''Tar processor, in streaming mode: the archive is read once, without seeking'''
+        self.cur_attachment.file_obj.seek(0)
+        archive = tarfile.open(mode='r|*', fileobj=self.cur_attachment.file_obj)
+        members = ((m.name, m.size, None, (lambda m=m: archive.extractfile(m)) if m.isfile() else None)
+                   for m in archive if not m.isdir())
+        return self._process_members(members)
 
     def _archive(self):
         '''Way to process Archive'''
@@ -468,67 +596,172 @@ class KittenGroomerMail(KittenGroomerMailBase):
     #######################
 
     def reassemble_mail(self, parsed_email, to_keep, attachments):
+        '''
+            attachments is a list of (path, [File, ...]), each path is replaced in place
+            by the sanitized files.
+        '''
         original_msgid = parsed_email.get_all('Message-ID')
         try:
             parsed_email.replace_header('Message-ID', make_msgid())
         except:
             parsed_email.add_header('Message-ID', make_msgid())
-        if to_keep:
-            if parsed_email.is_multipart():
-                parsed_email.set_payload([to_keep[0]])
-            else:
+        if not parsed_email.is_multipart():
+            if to_keep:
                 parsed_email.set_payload(to_keep[0])
-                return parsed_email
-        else:
+            return parsed_email
+        # Last paths first: replacing a part does not move the ones before it
+        top_logs = []
+        for path, files in sorted(attachments, key=lambda a: a[0], reverse=True):
+            parent = get_mime_part(parsed_email, path[:-1])
+            original = parent.get_payload()[path[-1]]
+            # Logs in a multipart/related or alternative would be shown as the body or ignored
+            logs_on_top = parent.get_content_type() in mimes_body
+            msg = []
+            logs = []
+            for f in files:
+                processing_info_msg, attachment_msg = self.pack_attachment(f)
+                self._copy_part_headers(original, attachment_msg, len(files) == 1)
+                if logs_on_top:
+                    logs.append(processing_info_msg)
+                else:
+                    msg.append(processing_info_msg)
+                msg.append(attachment_msg)
+            top_logs[0:0] = logs
+            if parent.get_content_maintype() == 'message':
+                # message/* parts contain exactly one message
+                msg = [MIMEMultipart('mixed', _subparts=msg)]
+            parent.get_payload()[path[-1]:path[-1] + 1] = msg
+        if parsed_email.get_content_type() in mimes_body:
+            self._wrap_in_mixed(parsed_email)
+        for processing_info_msg in top_logs:
+            parsed_email.attach(processing_info_msg)
+        if not to_keep:
             info_msg = MIMEText('Empty Message', _subtype='plain', _charset='utf-8')
-            parsed_email.set_payload([info_msg])
-        for k in to_keep[1:]:
-            parsed_email.attach(k)
+            parsed_email.get_payload().insert(0, info_msg)
         info = 'The attachments of this mail have been sanitzed.\nOriginal Message-ID: {}'.format(original_msgid)
         info_msg = MIMEText(info, _subtype='plain', _charset='utf-8')
         info_msg.add_header('Content-Disposition', 'attachment', filename='Sanitized.txt')
         parsed_email.attach(info_msg)
-        for f in attachments:
-            msg = self.pack_attachment(f)
-            for m in msg:
-                parsed_email.attach(m)
         return parsed_email
 
+    def _wrap_in_mixed(self, parsed_email):
+        '''
+            Move the body of the mail in a part of a new multipart/mixed root,
+            the headers of the mail (From, Subject, ...) stay on the root.
+        '''
+        body = Message()
+        content_headers = [(k, v) for k, v in parsed_email.items() if k.lower().startswith('content-')]
+        for key, value in content_headers:
+            body[key] = value
+        body.set_payload(parsed_email.get_payload())
+        body.preamble = parsed_email.preamble
+        body.epilogue = parsed_email.epilogue
+        for key in set(k for k, v in content_headers):
+            del parsed_email[key]
+        # The generator picks a new boundary
+        parsed_email['Content-Type'] = 'multipart/mixed'
+        parsed_email.set_payload([body])
+        parsed_email.preamble = None
+        parsed_email.epilogue = None
+
+    def _copy_part_headers(self, original, msg, keep_content_id):
+        '''
+            Keep the Content-ID (cid: references in HTML bodies) and the disposition
+            (inline or attachment) of the original part on the sanitized one.
+        '''
+        if keep_content_id and original.get('Content-ID'):
+            msg.add_header('Content-ID', original['Content-ID'])
+        disposition = original.get('Content-Disposition', '').split(';')[0].strip().lower()
+        if disposition != 'attachment':
+            filename = msg.get_filename()
+            del msg['Content-Disposition']
+            msg.add_header('Content-Disposition', 'inline', filename=filename)
+
     def pack_attachment(self, attachment):
         print(attachment.log_details)
         processing_info = '{}'.format(attachment.log_details)
         processing_info_msg = MIMEText(processing_info, _subtype='plain', _charset='utf-8')
         processing_info_msg.add_header('Content-Disposition', 'attachment', filename='{}.log'.format(attachment.orig_filename))
         msg = MIMEBase(attachment.main_type, attachment.sub_type)
-        msg.set_payload(attachment.file_obj.getvalue())
+        msg.set_payload(attachment.get_data())
         encoders.encode_base64(msg)
         msg.add_header('Content-Disposition', 'attachment', filename=attachment.final_filename)
         return [processing_info_msg, msg]
 
+    def _attachment_filename(self, path, part):
+        '''
+            Filename of the part, None if the part is a body part and not an attachment.
+        '''
+        if part.get_filename():
+            filename = decode_header(part.get_filename())
+            if filename[0][1]:
+                return filename[0][0].decode(filename[0][1])
+            return filename[0][0]
+        if part.get_content_maintype() != 'text':
+            # Nameless attachment, i.e. inline image in a multipart/related
+            ext = mimetypes.guess_extension(part.get_content_type()) or '.bin'
+            return 'part_{}{}'.format('.'.join(str(i) for i in path), ext)
+        return None
+
     def split_email(self, raw_email):
+        '''
+            Returns the paths of the body parts, the (path, filename, decoded payload) of
+            the attachments and the parsed email.
+        '''
         parsed_email = BytesParser().parsebytes(raw_email)
         to_keep = []
         attachments = []
-        if parsed_email.is_multipart():
-            for p in parsed_email.get_payload():
-                if p.get_filename():
-                    filename = decode_header(p.get_filename())
-                    if filename[0][1]:
-                        filename = filename[0][0].decode(filename[0][1])
-                    else:
-                        filename = filename[0][0]
-                    attachments.append(File(p.get_payload(decode=True), filename))
-                else:
-                    to_keep.append(p)
-        else:
+        if not parsed_email.is_multipart():
             to_keep.append(parsed_email.get_payload())
+            return to_keep, attachments, parsed_email
+        try:
+            for path, p in self.tree(parsed_email):
+                filename = self._attachment_filename(path, p)
+                if filename:
+                    attachments.append((path, filename, p.get_payload(decode=True)))
+                else:
+                    to_keep.append(path)
+        except MimeTreeError as e:
+            self.log_name.warning('Invalid MIME structure: {}', e.message)
+            info = 'The structure of this mail is too complex ({}), its content has been removed.'.format(e.message)
+            parsed_email.set_payload([MIMEText(info, _subtype='plain', _charset='utf-8')])
+            return [(0,)], [], parsed_email
         return to_keep, attachments, parsed_email
 
+    def _cache_key(self, parsed_email, to_keep, attachments):
+        '''
+            Hash of the content of the mail (body parts and attachments), ignoring the headers
+            of the mail, so a redelivered or fanned-out copy has the same key.
+        '''
+        digest = hashlib.sha256('{} {} {}\n'.format(self.full_report, self.strict_ole,
+                                                     self.max_recursive).encode())
+        for path in to_keep:
+            part = get_mime_part(parsed_email, path)
+            payload = part.get_payload(decode=True) or b''
+            digest.update('body {} {} {}\n'.format(path, part.get_content_type(), len(payload)).encode())
+            digest.update(payload)
+        for path, filename, payload in attachments:
+            digest.update('attachment {} {!r} {}\n'.format(path, filename, len(payload)).encode())
+            digest.update(payload)
+        return digest.hexdigest()
+
+    def _cache_put(self, cache_key, final_attach):
+        size = 0
+        for path, files in final_attach:
+            for f in files:
+                if not isinstance(f.file_obj, BytesIO):
+                    # Spilled to a temporary file, not shareable between groomers
+                    return
+                with f.file_obj.getbuffer() as buf:
+                    size += buf.nbytes
+        self.cache.put(cache_key, final_attach, size)
+
     def process_payload(self, payload):
         self.cur_attachment = payload
         self.log_name.info('Processing {} ({}/{})', self.cur_attachment.orig_filename,
                            self.cur_attachment.main_type, self.cur_attachment.sub_type)
-        if not self.cur_attachment.is_dangerous():
+        # In full report mode, the content of a file already dangerous is still analysed
+        if self.full_report or not self.cur_attachment.is_dangerous():
             self.mime_processing_options.get(self.cur_attachment.main_type, self.unknown)()
 
     def process_mail(self, raw_email=None):
@@ -544,15 +777,23 @@ class KittenGroomerMail(KittenGroomerMailBase):
             return self.pack_attachment(self.cur_attachment)
         else:
             to_keep, attachments, parsed_email = self.split_email(raw_email)
-            final_attach = set(attachments)
-            for f in attachments:
-                self.process_payload(f)
-                # At this point, self.cur_attachment can be a list (if the original one was an archive)
-                if isinstance(self.cur_attachment, list):
-                    final_attach.discard(f)
-                    final_attach.update(self.cur_attachment)
-                else:
-                    final_attach.discard(f)
-                    final_attach.add(self.cur_attachment)
+            # The sub-mails are part of the content of the mail they are attached to
+            use_cache = self.cache is not None and self.recursive == 0 and attachments
+            final_attach = None
+            if use_cache:
+                cache_key = self._cache_key(parsed_email, to_keep, attachments)
+                # Same body and attachments: only the headers differ, reuse the verdicts
+                final_attach = self.cache.get(cache_key)
+            if final_attach is None:
+                final_attach = []
+                for path, filename, payload in attachments:
+                    self.process_payload(File(payload, filename, self.full_report))
+                    # At this point, self.cur_attachment can be a list (if the original one was an archive)
+                    if isinstance(self.cur_attachment, list):
+                        final_attach.append((path, self.cur_attachment))
+                    else:
+                        final_attach.append((path, [self.cur_attachment]))
+                if use_cache:
+                    self._cache_put(cache_key, final_attach)
             parsed_email = self.reassemble_mail(parsed_email, to_keep, final_attach)
             return parsed_email
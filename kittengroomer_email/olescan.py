@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import struct
+
+from .helpers import KittenGroomerError
+
+# [MS-CFB] Compound File Binary format
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+MAXREGSECT = 0xFFFFFFFA
+ENDOFCHAIN = 0xFFFFFFFE
+NOSTREAM = 0xFFFFFFFF
+DIRENTRY_SIZE = 128
+# Header: signature, clsid, minor & major version, byte order, sector shift,
+# mini sector shift, reserved, number of directory and FAT sectors,
+# first directory sector, transaction signature, mini stream cutoff,
+# first mini FAT sector, number of mini FAT sectors, first DIFAT sector,
+# number of DIFAT sectors
+HEADER = struct.Struct('<8s16sHHHHH6sIIIIIIIII')
+DIFAT_IN_HEADER = 109
+
+# Storages and streams only present in documents with VBA macros
+macro_paths = ['macros/vba', 'Macros', '_VBA_PROJECT_CUR', 'VBA']
+
+
+class OleScanError(KittenGroomerError):
+    '''
+        The file is not a well-formed OLE2 file, the full olefile parser has to decide.
+    '''
+    pass
+
+
+class OleDirectory(object):
+
+    def __init__(self, data):
+        '''
+            Minimal OLE2 reader: only parses the header, the FAT sectors on the
+            chain of the directory and the directory itself.
+        '''
+        self.data = memoryview(data)
+        try:
+            self._load()
+        except Exception:
+            self.release()
+            raise
+
+    def _load(self):
+        if len(self.data) < 512:
+            raise OleScanError('File too small')
+        (signature, clsid, minor, major, byte_order, sector_shift, mini_sector_shift,
+         reserved, nb_dir_sectors, self.nb_fat_sectors, self.first_dir_sector,
+         transaction, cutoff, first_minifat, nb_minifat, self.first_difat_sector,
+         self.nb_difat_sectors) = HEADER.unpack_from(self.data)
+        if signature != OLE_SIGNATURE:
+            raise OleScanError('Invalid signature')
+        if byte_order != 0xFFFE:
+            raise OleScanError('Invalid byte order')
+        if (major, sector_shift) not in ((3, 9), (4, 12)):
+            raise OleScanError('Invalid version or sector size')
+        self.sector_size = 1 << sector_shift
+        self.entries_per_sector = self.sector_size // 4
+        # The first sector is the header, the last one may be truncated
+        self.nb_sectors = (len(self.data) - 1) // self.sector_size
+        self.difat = list(struct.unpack_from('<{}I'.format(DIFAT_IN_HEADER), self.data, HEADER.size))
+        self.difat_loaded = self.nb_fat_sectors <= DIFAT_IN_HEADER
+        self.entries = self._load_directory()
+
+    def _offset(self, sid):
+        if sid >= self.nb_sectors:
+            raise OleScanError('Sector {} out of the file'.format(sid))
+        return (sid + 1) * self.sector_size
+
+    def _read_uint(self, sid, index):
+        try:
+            return struct.unpack_from('<I', self.data, self._offset(sid) + 4 * index)[0]
+        except struct.error:
+            raise OleScanError('Truncated sector {}'.format(sid))
+
+    def _load_difat(self):
+        '''Only needed for the FAT sectors after the 109 first ones (> ~7MB files)'''
+        sid = self.first_difat_sector
+        seen = set()
+        # The header can not be trusted: a DIFAT chain is never longer than the file
+        for i in range(min(self.nb_difat_sectors, self.nb_sectors)):
+            if len(self.difat) >= self.nb_fat_sectors:
+                break
+            if sid > MAXREGSECT:
+                raise OleScanError('DIFAT chain too short')
+            if sid in seen:
+                raise OleScanError('Loop in the DIFAT chain')
+            seen.add(sid)
+            for index in range(self.entries_per_sector - 1):
+                self.difat.append(self._read_uint(sid, index))
+            sid = self._read_uint(sid, self.entries_per_sector - 1)
+        self.difat_loaded = True
+
+    def _next_sector(self, sid):
+        fat_index = sid // self.entries_per_sector
+        if fat_index >= self.nb_fat_sectors:
+            raise OleScanError('Sector {} not in the FAT'.format(sid))
+        if fat_index >= len(self.difat) and not self.difat_loaded:
+            self._load_difat()
+        if fat_index >= len(self.difat):
+            raise OleScanError('FAT sector {} not in the DIFAT'.format(fat_index))
+        return self._read_uint(self.difat[fat_index], sid % self.entries_per_sector)
+
+    def _chain(self, sid):
+        seen = set()
+        while sid != ENDOFCHAIN:
+            if sid > MAXREGSECT or sid in seen:
+                raise OleScanError('Invalid sector chain')
+            seen.add(sid)
+            yield sid
+            sid = self._next_sector(sid)
+
+    def _load_directory(self):
+        '''List of (name, left sibling, right sibling, child) for each directory entry'''
+        entries = []
+        for sid in self._chain(self.first_dir_sector):
+            offset = self._offset(sid)
+            for i in range(self.sector_size // DIRENTRY_SIZE):
+                entry = self.data[offset + i * DIRENTRY_SIZE:offset + (i + 1) * DIRENTRY_SIZE]
+                if len(entry) < DIRENTRY_SIZE:
+                    raise OleScanError('Truncated directory')
+                name_length, entry_type, color, left, right, child = struct.unpack_from('<HBBIII', entry, 64)
+                if entry_type == 0:
+                    entries.append(None)
+                    continue
+                if name_length > 64 or name_length % 2:
+                    raise OleScanError('Invalid directory entry name')
+                name = bytes(entry[:max(name_length - 2, 0)]).decode('utf-16-le', 'replace')
+                entries.append((name, left, right, child))
+        if not entries or entries[0] is None:
+            raise OleScanError('No root entry')
+        return entries
+
+    def _entry(self, index):
+        if index >= len(self.entries) or self.entries[index] is None:
+            raise OleScanError('Invalid directory entry {}'.format(index))
+        return self.entries[index]
+
+    def children(self, index):
+        '''Yields (name, index) of the children of a storage (walk of the red-black tree)'''
+        seen = set()
+        stack = [self._entry(index)[3]]
+        while stack:
+            index = stack.pop()
+            if index == NOSTREAM:
+                continue
+            if index in seen:
+                raise OleScanError('Loop in the directory')
+            seen.add(index)
+            name, left, right, child = self._entry(index)
+            yield name, index
+            stack.append(left)
+            stack.append(right)
+
+    def exists(self, path):
+        '''Same semantic as olefile.OleFileIO.exists: case insensitive, / separated'''
+        index = 0
+        for name in path.lower().split('/'):
+            for child_name, child_index in self.children(index):
+                if child_name.lower() == name:
+                    index = child_index
+                    break
+            else:
+                return False
+        return True
+
+    def release(self):
+        self.data.release()
+
+
+def has_macros(data):
+    '''
+        True if the OLE2 file in data (bytes or buffer) contains VBA macros.
+        Raises OleScanError if the file is malformed.
+    '''
+    ole = OleDirectory(data)
+    try:
+        return any(ole.exists(path) for path in macro_paths)
+    finally:
+        ole.release()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import queue
+
+
+class PipelineStats(object):
+
+    def __init__(self):
+        '''
+            Time spent working (busy) and blocked on a queue (wait) by each stage
+        '''
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, key, elapsed):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'busy': 0., 'wait': 0., 'items': 0})
+            entry[key] += elapsed
+
+    def count(self, stage):
+        with self.lock:
+            self.stages.setdefault(stage, {'busy': 0., 'wait': 0., 'items': 0})['items'] += 1
+
+    def report(self):
+        with self.lock:
+            return {stage: dict(entry) for stage, entry in self.stages.items()}
+
+
+# End of stream marker in the queues
+_STOP = object()
+
+
+class BatchPipeline(object):
+
+    def __init__(self, groom, read_ahead=8, write_behind=8, fsync_batch=0, workers=1, admission=None):
+        '''
+            Overlap reading, grooming and writing of a batch of mails.
+            groom is called with the raw email and returns the bytes to write.
+            read_ahead and write_behind are the depths of the queues between the stages.
+            Every fsync_batch written mails, they are fsync'ed together (0: never fsync).
+            workers is the number of grooming threads, admission an optional
+            AdmissionController limiting the memory used by the mails read and groomed.
+            With admission, the large mails are read by their own thread ('large' stage).
+        '''
+        # A queue of size 0 is unbounded and without groomers nothing drains the reader
+        for name, value in (('read_ahead', read_ahead), ('write_behind', write_behind), ('workers', workers)):
+            if value < 1:
+                raise ValueError('{} must be at least 1, not {}'.format(name, value))
+        if fsync_batch < 0:
+            raise ValueError('fsync_batch must be positive or 0, not {}'.format(fsync_batch))
+        self.groom = groom
+        self.read_ahead = read_ahead
+        self.write_behind = write_behind
+        self.fsync_batch = fsync_batch
+        self.workers = workers
+        self.admission = admission
+        self.stats = PipelineStats()
+
+    def _put(self, q, stage, item):
+        start = time.perf_counter()
+        q.put(item)
+        self.stats.add(stage, 'wait', time.perf_counter() - start)
+
+    def _get(self, q, stage):
+        start = time.perf_counter()
+        item = q.get()
+        self.stats.add(stage, 'wait', time.perf_counter() - start)
+        return item
+
+    def _stop_groomers(self, in_queue):
+        for i in range(self.workers):
+            in_queue.put(_STOP)
+
+    def _load(self, stage, f, path_in, path_out, ticket, in_queue):
+        '''Read the mail in the open file f and queue it for the groomers'''
+        start = time.perf_counter()
+        try:
+            raw_email = f.read()
+        except Exception:
+            print('Failed to read', path_in)
+            if ticket is not None:
+                self.admission.release(ticket)
+            return
+        self.stats.add(stage, 'busy', time.perf_counter() - start)
+        self.stats.count(stage)
+        self._put(in_queue, stage, (path_in, path_out, raw_email, ticket))
+
+    def _reader(self, jobs, in_queue, large_queue):
+        '''Prefetch the mails, blocks when read_ahead mails are waiting'''
+        try:
+            for path_in, path_out in jobs:
+                start = time.perf_counter()
+                try:
+                    f = open(path_in, 'rb')
+                except Exception:
+                    print('Failed to read', path_in)
+                    continue
+                with f:
+                    ticket = None
+                    if self.admission is not None:
+                        try:
+                            ticket = self.admission.ticket(f)
+                        except Exception:
+                            print('Failed to read', path_in)
+                            continue
+                    self.stats.add('reader', 'busy', time.perf_counter() - start)
+                    if ticket is not None:
+                        if ticket.large:
+                            # Waits for the large mail lane in its own thread, the next
+                            # mails are not held behind it
+                            large_queue.put((path_in, path_out, ticket))
+                            continue
+                        # The mail is in memory from now on: it has to fit in the budget
+                        start = time.perf_counter()
+                        self.admission.admit(ticket)
+                        self.stats.add('reader', 'wait', time.perf_counter() - start)
+                    self._load('reader', f, path_in, path_out, ticket, in_queue)
+        finally:
+            if large_queue is None:
+                self._stop_groomers(in_queue)
+            else:
+                large_queue.put(_STOP)
+
+    def _large_reader(self, in_queue, large_queue):
+        '''
+            Admit and read the large mails. The file is opened again: the large mails waiting
+            in large_queue (unbounded, it only holds their paths) do not hold a file descriptor.
+        '''
+        try:
+            while True:
+                item = self._get(large_queue, 'large')
+                if item is _STOP:
+                    break
+                path_in, path_out, ticket = item
+                start = time.perf_counter()
+                self.admission.admit(ticket)
+                self.stats.add('large', 'wait', time.perf_counter() - start)
+                try:
+                    f = open(path_in, 'rb')
+                except Exception:
+                    print('Failed to read', path_in)
+                    self.admission.release(ticket)
+                    continue
+                with f:
+                    self._load('large', f, path_in, path_out, ticket, in_queue)
+        finally:
+            self._stop_groomers(in_queue)
+
+    def _sync(self, pending):
+        '''fsync the files and their directories in one go'''
+        dirs = set()
+        for out in pending:
+            try:
+                os.fsync(out.fileno())
+                dirs.add(os.path.dirname(out.name) or '.')
+            except OSError:
+                print('Failed to sync', out.name)
+            finally:
+                out.close()
+        for d in dirs:
+            try:
+                fd = os.open(d, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def _writer(self, out_queue):
+        '''Write behind the groomer, batching the fsyncs'''
+        pending = []
+        while True:
+            item = self._get(out_queue, 'writer')
+            if item is _STOP:
+                break
+            path_out, content = item
+            start = time.perf_counter()
+            try:
+                if not os.path.exists(os.path.dirname(path_out)):
+                    os.makedirs(os.path.dirname(path_out))
+                if self.fsync_batch:
+                    out = open(path_out, 'wb')
+                    try:
+                        out.write(content)
+                        out.flush()
+                    except:
+                        out.close()
+                        raise
+                    pending.append(out)
+                else:
+                    with open(path_out, 'wb') as out:
+                        out.write(content)
+            except Exception:
+                print('Failed to write', path_out)
+            else:
+                self.stats.count('writer')
+            if self.fsync_batch and len(pending) >= self.fsync_batch:
+                self._sync(pending)
+                pending = []
+            self.stats.add('writer', 'busy', time.perf_counter() - start)
+        self._sync(pending)
+
+    def _groomer(self, in_queue, out_queue):
+        while True:
+            item = self._get(in_queue, 'groomer')
+            if item is _STOP:
+                break
+            path_in, path_out, raw_email, ticket = item
+            start = time.perf_counter()
+            try:
+                if ticket is None:
+                    content = self.groom(raw_email)
+                else:
+                    with self.admission.grooming(ticket, raw_email):
+                        content = self.groom(raw_email)
+            except Exception:
+                print('Failed to process', path_in)
+                continue
+            finally:
+                self.stats.add('groomer', 'busy', time.perf_counter() - start)
+            self.stats.count('groomer')
+            self._put(out_queue, 'groomer', (path_out, content))
+
+    def run(self, jobs):
+        '''
+            jobs is an iterable of (source path, destination path).
+        '''
+        in_queue = queue.Queue(maxsize=self.read_ahead)
+        out_queue = queue.Queue(maxsize=self.write_behind)
+        readers = []
+        large_queue = None
+        if self.admission is not None:
+            large_queue = queue.Queue()
+            readers.append(threading.Thread(target=self._large_reader, args=(in_queue, large_queue)))
+        readers.append(threading.Thread(target=self._reader, args=(jobs, in_queue, large_queue)))
+        writer = threading.Thread(target=self._writer, args=(out_queue,))
+        groomers = [threading.Thread(target=self._groomer, args=(in_queue, out_queue))
+                    for i in range(self.workers)]
+        for reader in readers:
+            reader.start()
+        writer.start()
+        for groomer in groomers:
+            groomer.start()
+        try:
+            for groomer in groomers:
+                groomer.join()
+        finally:
+            out_queue.put(_STOP)
+            for reader in readers:
+                reader.join()
+            writer.join()
+        report = self.stats.report()
+        if self.admission is not None:
+            report['admission'] = self.admission.report()
+        return report
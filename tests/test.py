@@ -4,9 +4,24 @@
 import unittest
 import os
 import sys
+import glob
+import tempfile
+import tarfile
+import struct
+import threading
 from io import BytesIO
+from email.parser import BytesParser
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
 
 from kittengroomer_email import KittenGroomerMail
+from kittengroomer_email.helpers import check_stats
+from kittengroomer_email.pipeline import BatchPipeline
+from kittengroomer_email.olescan import has_macros, OleScanError
+from kittengroomer_email.admission import AdmissionController, estimate_footprint
+from kittengroomer_email.cache import MessageCache
 
 if __name__ == '__main__':
     sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
@@ -32,3 +47,185 @@ class TestBasic(unittest.TestCase):
                     content = BytesIO(m.as_bytes())
                     with open(full_path.replace(src, dst), 'wb') as z:
                         z.write(content.getvalue())
+
+    def test_full_report(self):
+        mail = MIMEMultipart('mixed')
+        mail.attach(MIMEText('Body'))
+        attachment = MIMEText('Not really a script')
+        attachment.add_header('Content-Disposition', 'attachment', filename='invoice.js')
+        mail.attach(attachment)
+        check_stats.reset()
+        KittenGroomerMail(mail.as_bytes()).process_mail()
+        fast = [c['name'] for c in check_stats.report()]
+        check_stats.reset()
+        KittenGroomerMail(mail.as_bytes(), full_report=True).process_mail()
+        full = [c['name'] for c in check_stats.report()]
+        # Dangerous by its name: the fast mode stops at the extension check
+        self.assertEqual(sorted(fast), ['malicious_extension', 'no_extension', 'no_mimetype'])
+        self.assertIn('expected_mimetype', full)
+        self.assertIn('expected_extensions', full)
+
+    def test_full_report_handlers(self):
+        with open(os.path.join(self.curpath, 'tests/mail_src/xls.eml'), 'rb') as f:
+            mail = BytesParser().parsebytes(f.read())
+        for part in mail.walk():
+            if part.get_filename() == 'Bill_744303191.xls':
+                part.set_param('filename', 'Bill_744303191.exe', header='Content-Disposition')
+        for full_report in (False, True):
+            m = KittenGroomerMail(mail.as_bytes(), full_report=full_report).process_mail()
+            log = [p for p in m.walk() if p.get_filename() == 'Bill_744303191.exe.log'][0]
+            # The content of a file dangerous by its name is only analysed in full report mode
+            self.assertEqual("'macro': True" in log.get_payload(decode=True).decode(), full_report)
+
+    def test_nested_attachment(self):
+        nested = MIMEMultipart('mixed')
+        nested.attach(MIMEText('<b>Body</b>', 'html'))
+        attachment = MIMEApplication(b'MZ\x90\x00\x03\x00\x00\x00')
+        attachment.add_header('Content-Disposition', 'attachment', filename='invoice.exe')
+        nested.attach(attachment)
+        mail = MIMEMultipart('alternative')
+        mail.attach(MIMEText('Body'))
+        mail.attach(nested)
+        m = KittenGroomerMail(mail.as_bytes()).process_mail()
+        filenames = [p.get_filename() for p in m.get_payload()[0].get_payload()[1].get_payload()]
+        self.assertEqual(filenames, [None, 'invoice.exe.log', 'DANGEROUS_invoice.exe_DANGEROUS'])
+
+    def test_inline_image(self):
+        related = MIMEMultipart('related')
+        related.attach(MIMEText('<img src="cid:logo">', 'html'))
+        image = MIMEImage(b'GIF89a\x01\x00\x01\x00\x00\x00\x00;', 'gif')
+        image.add_header('Content-ID', '<logo>')
+        related.attach(image)
+        mail = MIMEMultipart('alternative')
+        mail.attach(MIMEText('Body'))
+        mail.attach(related)
+        mail['Subject'] = 'Logo'
+        m = KittenGroomerMail(mail.as_bytes()).process_mail()
+        # The logs and Sanitized.txt are next to the original body, not in it
+        self.assertEqual(m.get_content_type(), 'multipart/mixed')
+        self.assertEqual(m['Subject'], 'Logo')
+        body, log, sanitized = m.get_payload()
+        self.assertEqual(body.get_content_type(), 'multipart/alternative')
+        self.assertEqual(len(body.get_payload()), 2)
+        related_parts = body.get_payload()[1].get_payload()
+        self.assertEqual(len(related_parts), 2)
+        self.assertEqual(related_parts[1]['Content-ID'], '<logo>')
+        self.assertTrue(related_parts[1]['Content-Disposition'].startswith('inline'))
+        self.assertTrue(log.get_filename().endswith('.log'))
+        self.assertEqual(sanitized.get_filename(), 'Sanitized.txt')
+        # Root multipart/related
+        m = KittenGroomerMail(related.as_bytes()).process_mail()
+        self.assertEqual([p.get_content_type() for p in m.get_payload()],
+                         ['multipart/related', 'text/plain', 'text/plain'])
+        self.assertEqual(len(m.get_payload()[0].get_payload()), 2)
+
+    def test_too_many_parts(self):
+        mail = MIMEMultipart('mixed')
+        for i in range(20):
+            mail.attach(MIMEText('Part {}'.format(i)))
+        m = KittenGroomerMail(mail.as_bytes(), max_parts=10).process_mail()
+        self.assertIn('too complex', m.get_payload()[0].get_payload(decode=True).decode())
+
+    def test_pipeline(self):
+        src = os.path.join(self.curpath, 'tests/mail_src')
+        dst = tempfile.mkdtemp()
+        jobs = [(f, f.replace(src, dst)) for f in glob.glob(os.path.join(src, '*'))]
+        stats = BatchPipeline(lambda raw_email: raw_email, read_ahead=2, write_behind=2, fsync_batch=3).run(jobs)
+        self.assertEqual(stats['writer']['items'], len(jobs))
+        for f, outfile in jobs:
+            with open(f, 'rb') as i, open(outfile, 'rb') as o:
+                self.assertEqual(i.read(), o.read())
+        for kwargs in ({'read_ahead': 0}, {'write_behind': 0}, {'workers': 0}, {'fsync_batch': -1}):
+            self.assertRaises(ValueError, BatchPipeline, lambda raw_email: raw_email, **kwargs)
+        # A mail that can not be written is not counted
+        for fsync_batch in (0, 3):
+            dst = tempfile.mkdtemp()
+            jobs = [(f, f.replace(src, dst)) for f in glob.glob(os.path.join(src, '*'))]
+            os.mkdir(jobs[0][1])
+            stats = BatchPipeline(lambda raw_email: raw_email, fsync_batch=fsync_batch).run(jobs)
+            self.assertEqual(stats['writer']['items'], len(jobs) - 1)
+
+    def test_ole_prescan(self):
+        with open(os.path.join(self.curpath, 'tests/mail_src/xls.eml'), 'rb') as f:
+            raw_email = f.read()
+        for strict_ole in (False, True):
+            m = KittenGroomerMail(raw_email, strict_ole=strict_ole).process_mail()
+            filenames = [p.get_filename() for p in m.walk()]
+            self.assertIn('DANGEROUS_Bill_744303191.xls_DANGEROUS', filenames)
+        self.assertRaises(OleScanError, has_macros, b'Not an OLE2 file' * 64)
+
+    def test_ole_prescan_difat_loop(self):
+        # Directory sector after the 109 FAT sectors listed in the header, DIFAT sector 0
+        # pointing to itself and an absurd number of DIFAT sectors
+        first_dir_sector = 109 * 128
+        ole = bytearray(512 * (first_dir_sector + 2))
+        struct.pack_into('<8s16sHHHHH6sIIIIIIIII', ole, 0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'',
+                         0x3E, 3, 0xFFFE, 9, 6, b'', 0, 1000, first_dir_sector, 0, 4096,
+                         0xFFFFFFFE, 0, 0, 0xFFFFFFFF)
+        self.assertRaises(OleScanError, has_macros, ole)
+
+    def test_admission(self):
+        src = os.path.join(self.curpath, 'tests/mail_src')
+        dst = tempfile.mkdtemp()
+        jobs = [(f, f.replace(src, dst)) for f in glob.glob(os.path.join(src, '*'))]
+        admission = AdmissionController(2 ** 24, sample_every=3)
+        stats = BatchPipeline(lambda raw_email: raw_email.upper(), workers=3, admission=admission).run(jobs)
+        self.assertEqual(stats['admission']['admitted'], len(jobs))
+        self.assertEqual(stats['admission']['samples'], len(jobs) // 3)
+        self.assertIn('ratio_mean', stats['admission'])
+        self.assertLessEqual(stats['admission']['peak_in_flight'], 2 ** 24)
+        # A large mail waiting for the large mail lane does not block the small ones behind it
+        src = tempfile.mkdtemp()
+        jobs = []
+        for name, size in (('large1', 4096), ('large2', 4096), ('small', 16)):
+            with open(os.path.join(src, name), 'wb') as f:
+                f.write(b'a' * size)
+            jobs.append((os.path.join(src, name), os.path.join(dst, name)))
+        small_done = threading.Event()
+
+        def groom(raw_email):
+            if len(raw_email) > 1024 and not small_done.wait(5):
+                raise Exception('Small mail blocked behind the large ones')
+            small_done.set()
+            return raw_email
+        admission = AdmissionController(2 ** 24, large_threshold=4 * 1024)
+        stats = BatchPipeline(groom, workers=2, admission=admission).run(jobs)
+        self.assertEqual(stats['writer']['items'], 3)
+        self.assertEqual(stats['admission']['large'], 2)
+        with open(os.path.join(self.curpath, 'tests/mail_src/zip.eml'), 'rb') as f:
+            raw_email = f.read()
+        self.assertGreater(estimate_footprint(len(raw_email), raw_email), 4 * len(raw_email))
+
+    def test_archive_prefilter(self):
+        tar = BytesIO()
+        with tarfile.open(fileobj=tar, mode='w|gz') as archive:
+            for name, content in (('notes.txt', b'Some notes\n'), ('INVOICE.JS', b'alert(1)'),
+                                  ('README', b'Read me\n')):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, BytesIO(content))
+        mail = MIMEMultipart('mixed')
+        mail.attach(MIMEText('Body'))
+        attachment = MIMEApplication(tar.getvalue())
+        attachment.add_header('Content-Disposition', 'attachment', filename='archive.tar.gz')
+        mail.attach(attachment)
+        m = KittenGroomerMail(mail.as_bytes()).process_mail()
+        parts = {p.get_filename(): p for p in m.get_payload()}
+        self.assertEqual(parts['notes.txt'].get_payload(decode=True), b'Some notes\n')
+        self.assertIn('not_extracted', parts['INVOICE.JS.log'].get_payload(decode=True).decode())
+        self.assertEqual(parts['INVOICE.JS.removed'].get_content_type(), 'application/octet-stream')
+        self.assertEqual(parts['INVOICE.JS.removed'].get_payload(decode=True), b'')
+        # Dangerous, but not because of its name: the content is kept
+        self.assertEqual(parts['DANGEROUS_README_DANGEROUS'].get_payload(decode=True), b'Read me\n')
+
+    def test_cache(self):
+        with open(os.path.join(self.curpath, 'tests/mail_src/zip.eml'), 'rb') as f:
+            raw_email = f.read()
+        cache = MessageCache()
+        first = KittenGroomerMail(raw_email, cache=cache).process_mail()
+        redelivered = b'Received: from relay.example.com\r\n' + raw_email
+        second = KittenGroomerMail(redelivered, cache=cache).process_mail()
+        self.assertEqual(cache.report()['hits'], 1)
+        self.assertEqual([p.get_filename() for p in first.walk()], [p.get_filename() for p in second.walk()])
+        self.assertNotEqual(first['Message-ID'], second['Message-ID'])
+        self.assertIn('relay.example.com', second['Received'])